@@ -24,7 +24,11 @@ from __future__ import print_function
 import collections
 from concurrent import futures
 import hashlib
+import itertools
+import json
 import logging
+import mmap
+import multiprocessing
 import os
 import posixpath
 import re
@@ -32,6 +36,7 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import zipfile
 
@@ -73,6 +78,13 @@ FLAGS = flags.FLAGS
 
 DEVICE_DIRECTORY = "/data/local/tmp/incrementaldeployment"
 
+# Directory under the user's home directory where data that can be reused by
+# subsequent invocations is kept.
+CACHE_DIRECTORY = os.path.join(".cache", "bazel-mobile-install")
+
+# The maximum number of files whose checksum is cached.
+MAX_CACHED_CHECKSUMS = 16
+
 # Some devices support ABIs other than those reported by getprop. In this case,
 # if the most specific ABI is not available in the .apk, we push the more
 # general ones.
@@ -81,6 +93,10 @@ COMPATIBLE_ABIS = {
     "arm64-v8a": ["armeabi-v7a", "armeabi"]
 }
 
+# The maximum number of files pushed by a single 'adb push' invocation. This
+# keeps the command line well below the length limit on Windows.
+MAX_FILES_PER_PUSH = 100
+
 
 class AdbError(Exception):
   """An exception class signaling an error in an adb invocation."""
@@ -103,12 +119,21 @@ class DeviceNotFoundError(Exception):
   """Raised when the device could not be found."""
 
 
+# The errors from adb when more than one device is attached.
+MULTIPLE_DEVICES_RE = re.compile(
+    "more than one (device and emulator|device|emulator)")
+
+
+# The first installation time of a package in the output of dumpsys.
+INSTALL_TIME_RE = re.compile("firstInstallTime=(.*)$", re.MULTILINE)
+
+
 class MultipleDevicesError(Exception):
   """Raised when > 1 device is attached and no device serial was given."""
 
   @staticmethod
   def CheckError(s):
-    return re.search("more than one (device and emulator|device|emulator)", s)
+    return "more than one " in s and MULTIPLE_DEVICES_RE.search(s)
 
 
 class DeviceUnauthorizedError(Exception):
@@ -131,6 +156,50 @@ hostpath = os.path
 targetpath = posixpath
 
 
+def _LinkOrCopy(src, dst):
+  """Hard links src to dst, or copies it if that is not possible."""
+  try:
+    os.link(src, dst)
+  except (AttributeError, OSError):
+    shutil.copyfile(src, dst)
+
+
+def _DeleteCommand(remote_files):
+  """Returns a shell command deleting the given files, or None if none."""
+  files_str = " ".join(remote_files)
+  return "rm -fr %s" % files_str if files_str else None
+
+
+def _MkdirCommand(d):
+  """Returns a shell command creating the given directory."""
+  return "mkdir -p %s" % d
+
+
+def _BalanceBySize(files, num_groups):
+  """Splits files into groups of at most MAX_FILES_PER_PUSH of similar size.
+
+  Largest first, each file goes to the group with the fewest bytes so far
+  that still has room, so that parallel pushes finish at about the same time.
+
+  Args:
+    files: The paths of the files to split.
+    num_groups: The number of groups. Must be large enough to hold all files.
+
+  Returns:
+    A list of num_groups lists of paths.
+  """
+  sizes = [os.path.getsize(f) for f in files]
+  groups = [[] for _ in range(num_groups)]
+  group_sizes = [0] * num_groups
+  for i in sorted(range(len(files)), key=lambda i: sizes[i], reverse=True):
+    g = min((g for g in range(num_groups)
+             if len(groups[g]) < MAX_FILES_PER_PUSH),
+            key=lambda g: group_sizes[g])
+    groups[g].append(files[i])
+    group_sizes[g] += sizes[i]
+  return groups
+
+
 class Adb(object):
   """A class to handle interaction with adb."""
 
@@ -139,17 +208,20 @@ class Adb(object):
     self._adb_path = adb_path
     self._temp_dir = temp_dir
     self._user_home_dir = user_home_dir
-    self._file_counter = 1
+    self._file_counter = itertools.count(1)
+    self._adb_jobs = adb_jobs
     self._executor = futures.ThreadPoolExecutor(max_workers=adb_jobs)
     self._extra_adb_args = extra_adb_args or []
-
-  def _Exec(self, adb_args):
-    """Executes the given adb command + args."""
-    args = [self._adb_path] + self._extra_adb_args + adb_args
-    # TODO(ahumesky): Because multiple instances of adb are executed in
-    # parallel, these debug logging lines will get interleaved.
-    logging.debug("Executing: %s", " ".join(args))
-
+    self._shell = None
+    self._shell_args = None
+    self._shell_lock = threading.Lock()
+    self._shell_counter = itertools.count(1)
+    self._active = set()
+    self._active_lock = threading.Lock()
+    self._aborted = False
+
+  def _Popen(self, args, stderr):
+    """Starts adb with the given arguments."""
     # adb sometimes requires the user's home directory to access things in
     # $HOME/.android (e.g. keys to authorize with the device). To avoid any
     # potential problems with python picking up things in the user's home
@@ -167,23 +239,50 @@ class Adb(object):
                            "be set or Adb won't work"))
       env["SYSTEMROOT"] = value
 
-    adb = subprocess.Popen(
+    return subprocess.Popen(
         args,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+        stderr=stderr,
         env=env)
-    stdout, stderr = adb.communicate()
+
+  def _Exec(self, adb_args, stdin_data=None):
+    """Executes the given adb command + args, feeding it stdin_data if given."""
+    args = [self._adb_path] + self._extra_adb_args + adb_args
+    # TODO(ahumesky): Because multiple instances of adb are executed in
+    # parallel, these debug logging lines will get interleaved.
+    logging.debug("Executing: %s", " ".join(args))
+
+    adb = self._Popen(args, subprocess.PIPE)
+    with self._active_lock:
+      self._active.add(adb)
+      if self._aborted:
+        adb.kill()
+    try:
+      # On POSIX, communicate() multiplexes stdin, stdout and stderr with
+      # select/poll in the calling thread and starts no reader threads, so
+      # parallel adb jobs cost one thread each. Only on Windows, where pipes
+      # cannot be selected on, does it use helper threads.
+      stdout, stderr = adb.communicate(stdin_data)
+    finally:
+      with self._active_lock:
+        self._active.discard(adb)
     stdout = stdout.strip()
     stderr = stderr.strip()
     logging.debug("adb ret: %s", adb.returncode)
     logging.debug("adb out: %s", stdout)
     logging.debug("adb err: %s", stderr)
 
-    # Check these first so that the more specific error gets raised instead of
-    # the more generic AdbError.
     stdout = six.ensure_str(stdout)
     stderr = six.ensure_str(stderr)
+    Adb._CheckErrors(args, adb.returncode, stdout, stderr)
+    return adb.returncode, stdout, stderr, args
+
+  @staticmethod
+  def _CheckErrors(args, returncode, stdout, stderr):
+    """Raises the appropriate exception if an adb invocation failed."""
+    # Check these first so that the more specific error gets raised instead of
+    # the more generic AdbError.
     if "device not found" in stderr:
       raise DeviceNotFoundError()
     elif "device unauthorized" in stderr:
@@ -192,33 +291,50 @@ class Adb(object):
       # The error messages are from adb's transport.c, but something adds
       # "error: " to the beginning, so take it off so that we don't end up
       # printing "Error: error: ..."
-      raise MultipleDevicesError(re.sub("^error: ", "", stderr))
+      if stderr.startswith("error: "):
+        stderr = stderr[len("error: "):]
+      raise MultipleDevicesError(stderr)
     elif "INSTALL_FAILED_OLDER_SDK" in stdout:
       raise OldSdkException()
 
-    if adb.returncode != 0:
-      raise AdbError(args, adb.returncode, stdout, stderr)
+    if returncode != 0:
+      raise AdbError(args, returncode, stdout, stderr)
 
-    return adb.returncode, stdout, stderr, args
+  def _ExecParallel(self, adb_args, stdin_data=None):
+    return self._executor.submit(self._Exec, adb_args, stdin_data)
 
-  def _ExecParallel(self, adb_args):
-    return self._executor.submit(self._Exec, adb_args)
+  def AbortAll(self):
+    """Kills the adb processes that are running and the ones started later.
+
+    Cancelling a future does not stop an adb process that is already running,
+    so this lets pending uploads fail fast once the installation is given up.
+    """
+    with self._active_lock:
+      self._aborted = True
+      for adb in self._active:
+        try:
+          adb.kill()
+        except EnvironmentError:
+          # The process has already exited.
+          pass
 
   def _CreateLocalFile(self):
     """Returns a path to a temporary local file in the temp directory."""
-    local = hostpath.join(self._temp_dir, "adbfile_%d" % self._file_counter)
-    self._file_counter += 1
-    return local
+    return hostpath.join(self._temp_dir,
+                         "adbfile_%d" % next(self._file_counter))
 
   def GetInstallTime(self, package):
     """Get the installation time of a package."""
-    _, stdout, _, _ = self._Shell("dumpsys package %s" % package)
-    match = re.search("firstInstallTime=(.*)$", six.ensure_str(stdout),
-                      re.MULTILINE)
-    if match:
-      return match.group(1)
-    else:
-      return None
+    # The output of dumpsys can be hundreds of kilobytes, so only transfer the
+    # line we need. If grep is not available on the device, fall back to
+    # looking at the whole output.
+    for cmd in ("dumpsys package %s | grep firstInstallTime= || true",
+                "dumpsys package %s"):
+      _, stdout, _, _ = self._Shell(cmd % package)
+      match = INSTALL_TIME_RE.search(six.ensure_str(stdout))
+      if match:
+        return match.group(1)
+    return None
 
   def GetAbi(self):
     """Returns the ABI the device supports."""
@@ -229,12 +345,111 @@ class Adb(object):
     """Invoke 'adb push' in parallel."""
     return self._ExecParallel(["push", local, remote])
 
+  def PushBatch(self, files):
+    """Push multiple files to the device in parallel.
+
+    Files going to the same directory on the device are pushed together with
+    a single 'adb push' so that they share one sync session instead of paying
+    for a new adb process and connection each.
+
+    Args:
+      files: A list of (local, remote) tuples.
+
+    Returns:
+      A list of futures, one for each adb invocation.
+    """
+    by_remote_dir = collections.defaultdict(list)
+    for local, remote in files:
+      by_remote_dir[targetpath.dirname(remote)].append((local, remote))
+
+    fs = []
+    for remote_dir, dir_files in by_remote_dir.items():
+      if len(dir_files) == 1:
+        fs.append(self.Push(*dir_files[0]))
+        continue
+
+      # 'adb push' names the files on the device after the local files, so
+      # stage the ones whose name differs under their name on the device.
+      staging_dir = None
+      local_files = []
+      for local, remote in dir_files:
+        name = targetpath.basename(remote)
+        if hostpath.basename(local) != name:
+          if staging_dir is None:
+            staging_dir = self._CreateLocalFile()
+            os.mkdir(staging_dir)
+          staged = hostpath.join(staging_dir, name)
+          _LinkOrCopy(local, staged)
+          local = staged
+        local_files.append(local)
+
+      # Spread the files over all the adb jobs.
+      num_pushes = max(
+          min(self._adb_jobs, len(local_files)),
+          (len(local_files) + MAX_FILES_PER_PUSH - 1) // MAX_FILES_PER_PUSH)
+      for push_files in _BalanceBySize(local_files, num_pushes):
+        fs.append(self._ExecParallel(
+            ["push"] + push_files + [remote_dir + "/"]))
+
+    return fs
+
   def PushString(self, contents, remote):
     """Push a given string to a given path on the device in parallel."""
-    local = self._CreateLocalFile()
-    with open(local, "wb") as f:
-      f.write(contents.encode("utf-8"))
-    return self.Push(local, remote)
+    # 'exec-in' pipes stdin to the command without a terminal in between, so
+    # the contents arrive unchanged and without a local temporary file.
+    return self._ExecParallel(["exec-in", "cat > %s" % remote],
+                              contents.encode("utf-8"))
+
+  def PushStringAfter(self, fs, contents, remote):
+    """Push a given string to the device once the given futures succeeded.
+
+    Args:
+      fs: The futures to wait for.
+      contents: The string to push.
+      remote: The path on the device to push it to.
+
+    Returns:
+      A future that completes once the string was pushed. If any of the given
+      futures failed, nothing is pushed and the future fails, too.
+    """
+    fs = list(fs)
+    result = futures.Future()
+    pending = [len(fs)]
+    lock = threading.Lock()
+
+    def _CopyOutcome(f):
+      try:
+        result.set_result(f.result())
+      except Exception as e:  # pylint: disable=broad-except
+        result.set_exception(e)
+
+    def _Push():
+      if not result.set_running_or_notify_cancel():
+        return
+      for f in fs:
+        if f.cancelled():
+          result.set_exception(futures.CancelledError())
+          return
+        if f.exception() is not None:
+          result.set_exception(f.exception())
+          return
+      try:
+        self.PushString(contents, remote).add_done_callback(_CopyOutcome)
+      except Exception as e:  # pylint: disable=broad-except
+        result.set_exception(e)
+
+    def _OnDone(_):
+      with lock:
+        pending[0] -= 1
+        if pending[0]:
+          return
+      _Push()
+
+    if not fs:
+      _Push()
+    for f in fs:
+      f.add_done_callback(_OnDone)
+    return result
 
   def Pull(self, remote):
     """Invoke 'adb pull'.
@@ -289,13 +504,22 @@ class Adb(object):
 
   def DeleteMultiple(self, remote_files):
     """Delete the given files (or directories) on the device."""
-    files_str = " ".join(remote_files)
-    if files_str:
-      self._Shell("rm -fr %s" % files_str)
+    cmd = _DeleteCommand(remote_files)
+    if cmd:
+      self._Shell(cmd)
 
   def Mkdir(self, d):
     """Invokes mkdir with the specified directory on the device."""
-    self._Shell("mkdir -p %s" % d)
+    self._Shell(_MkdirCommand(d))
+
+  def BatchShell(self, cmds):
+    """Runs the given shell commands in one go, stopping at the first failure.
+
+    Empty commands are skipped.
+    """
+    cmds = [cmd for cmd in cmds if cmd]
+    if cmds:
+      return self._Shell(" && ".join(cmds))
 
   def StopApp(self, package):
     """Force stops the app with the given package."""
@@ -318,8 +542,83 @@ class Adb(object):
     self._Shell("monkey -p %s -c android.intent.category.LAUNCHER 1" % package)
 
   def _Shell(self, cmd):
-    """Invoke 'adb shell'."""
-    return self._Exec(["shell", cmd])
+    """Invoke a command in 'adb shell'.
+
+    All commands run in a single shell session on the device, which is started
+    on first use, so that each of them does not need a new adb process and
+    connection. The output of each command is delimited by echoing markers
+    around it.
+
+    Args:
+      cmd: The command line to run.
+
+    Returns:
+      A (returncode, stdout, stderr, args) tuple like _Exec. The output of the
+      command on stderr is part of stdout.
+    """
+    with self._shell_lock:
+      if self._shell is None:
+        self._shell_args = [self._adb_path] + self._extra_adb_args + ["shell"]
+        logging.debug("Executing: %s", " ".join(self._shell_args))
+        self._shell = self._Popen(self._shell_args, subprocess.STDOUT)
+
+      args = self._shell_args + [cmd]
+      logging.debug("Executing: %s", " ".join(args))
+      n = next(self._shell_counter)
+      begin = "__BEGIN_%d__" % n
+      end = "__END_%d__ " % n
+      try:
+        self._shell.stdin.write(
+            ("echo %s\n%s\necho %s$?\n" % (begin, cmd, end)).encode("utf-8"))
+        self._shell.stdin.flush()
+      except EnvironmentError:
+        # The session is gone. Its output tells why.
+        pass
+
+      # Anything before the begin marker is either the command echoed by a
+      # terminal on the device or an error from adb itself.
+      preamble = []
+      output = None
+      returncode = None
+      while True:
+        line = self._shell.stdout.readline()
+        if not line:
+          break
+        line = six.ensure_str(line, "utf-8").rstrip("\r\n")
+        if output is None:
+          if line == begin:
+            output = []
+          else:
+            preamble.append(line)
+        elif line.startswith(end):
+          returncode = int(line[len(end):])
+          break
+        else:
+          output.append(line)
+
+      if returncode is None:
+        # adb exited before the command finished.
+        self._shell.wait()
+        shell_returncode = self._shell.returncode
+        self._shell = None
+        stderr = "\n".join(preamble + (output or [])).strip()
+        logging.debug("adb ret: %s", shell_returncode)
+        logging.debug("adb err: %s", stderr)
+        Adb._CheckErrors(args, shell_returncode, "", stderr)
+        raise AdbError(args, shell_returncode, "", stderr)
+
+    stdout = "\n".join(output).strip()
+    logging.debug("adb ret: %s", returncode)
+    logging.debug("adb out: %s", stdout)
+    Adb._CheckErrors(args, returncode, stdout, "")
+    return returncode, stdout, "", args
+
+  def Close(self):
+    """Ends the shell session on the device, if there is one."""
+    with self._shell_lock:
+      if self._shell is not None:
+        self._shell.communicate(b"exit\n")
+        self._shell = None
 
   @staticmethod
   def _IsHostOsWindows():
@@ -329,6 +628,10 @@ class Adb(object):
 ManifestEntry = collections.namedtuple(
     "ManifestEntry", ["input_file", "zippath", "installpath", "sha256"])
 
+# A line of a dexmanifest: input file, zip path, install path and checksum.
+MANIFEST_LINE_RE = re.compile(
+    r"^[^\S\n]*(\S+) (\S+) (\S+) (\S+)[^\S\n]*$", re.MULTILINE)
+
 
 def ParseManifest(contents):
   """Parses a dexmanifest file.
@@ -339,13 +642,8 @@ def ParseManifest(contents):
   Returns:
     A dict of install path -> ManifestEntry.
   """
-  result = {}
-
-  for l in contents.split("\n"):
-    entry = ManifestEntry(*(l.strip().split(" ")))
-    result[entry.installpath] = entry
-
-  return result
+  return dict((m[2], ManifestEntry._make(m))
+              for m in MANIFEST_LINE_RE.findall(contents))
 
 
 def GetAppPackage(stub_datafile):
@@ -354,7 +652,8 @@ def GetAppPackage(stub_datafile):
     return six.ensure_str(f.readlines()[1], "utf-8").strip()
 
 
-def UploadDexes(adb, execroot, app_dir, temp_dir, dexmanifest, full_install):
+def UploadDexes(adb, execroot, app_dir, temp_dir, dexmanifest, full_install,
+                cache_dir=None):
   """Uploads dexes to the device so that the state.
 
   Does the minimum amount of work necessary to make the state of the device
@@ -367,15 +666,18 @@ def UploadDexes(adb, execroot, app_dir, temp_dir, dexmanifest, full_install):
     temp_dir: a local temporary directory
     dexmanifest: contents of the dex manifest
     full_install: whether to do a full install
+    cache_dir: the local cache directory. May be None to disable caching.
 
   Returns:
-    None.
+    A list of futures for the pending uploads. The dex manifest is written
+    after all dexes were uploaded successfully.
   """
 
   # Fetch the manifest on the device
   dex_dir = targetpath.join(app_dir, "dex")
-  adb.Mkdir(dex_dir)
-
+  # The loops over dexes below build paths by concatenating to a prefix, which
+  # is cheaper than calling join() for each of thousands of dexes.
+  dex_prefix = dex_dir + "/"
   old_manifest = None
 
   if not full_install:
@@ -391,125 +693,361 @@ def UploadDexes(adb, execroot, app_dir, temp_dir, dexmanifest, full_install):
     # was interrupted. Wipe the slate clean. Do this also in case we do a full
     # installation.
     old_manifest = {}
-    adb.Delete(targetpath.join(dex_dir, "*"))
+    to_delete = [targetpath.join(dex_dir, "*")]
+  else:
+    # Delete the manifest so that we know how to get back to a consistent
+    # state if we are interrupted.
+    to_delete = [targetpath.join(dex_dir, "manifest")]
 
   new_manifest = ParseManifest(dexmanifest)
-  dexes_to_delete = set(old_manifest) - set(new_manifest)
+  dexes_to_delete = six.viewkeys(old_manifest) - six.viewkeys(new_manifest)
 
   # Figure out which dexes to upload: those that are present in the new manifest
-  # but not in the old one and those whose checksum was changed
-  common_dexes = set(new_manifest).intersection(old_manifest)
-  dexes_to_upload = set(d for d in common_dexes
-                        if new_manifest[d].sha256 != old_manifest[d].sha256)
-  dexes_to_upload.update(set(new_manifest) - set(old_manifest))
+  # but not in the old one and those whose checksum was changed. Both are the
+  # (dex, checksum) pairs of the new manifest missing from the old one.
+  new_checksums = dict((d, e.sha256) for d, e in six.iteritems(new_manifest))
+  old_checksums = dict((d, e.sha256) for d, e in six.iteritems(old_manifest))
+  dexes_to_upload = set(
+      d for d, _ in six.viewitems(new_checksums) - six.viewitems(old_checksums))
 
-  if not dexes_to_delete and not dexes_to_upload:
+  if old_manifest and not dexes_to_delete and not dexes_to_upload:
     # If we have nothing to do, don't bother removing and rewriting the manifest
     logging.info("Application dexes up-to-date")
-    return
+    return []
 
-  # Delete the manifest so that we know how to get back to a consistent state
-  # if we are interrupted.
-  adb.Delete(targetpath.join(dex_dir, "manifest"))
+  num_files = len(dexes_to_delete) + len(dexes_to_upload)
+  logging.info("Updating %d dex%s...", num_files, "es" if num_files > 1 else "")
 
-  # Tuple of (local, remote) files to push to the device.
-  files_to_push = []
+  # Create the dex directory, delete the manifest or wipe the directory, and
+  # delete the dexes that are not in the new manifest, all in one go.
+  to_delete.extend(dex_prefix + dex for dex in dexes_to_delete)
+  adb.BatchShell([_MkdirCommand(dex_dir), _DeleteCommand(to_delete)])
 
   # Sort dexes to be uploaded by the zip file they are in so that we only need
   # to open each zip only once.
-  dexzips_in_upload = set(new_manifest[d].input_file for d in dexes_to_upload
-                          if new_manifest[d].zippath != "-")
-  for i, dexzip_name in enumerate(dexzips_in_upload):
-    zip_dexes = [
-        d for d in dexes_to_upload if new_manifest[d].input_file == dexzip_name]
-    dexzip_tempdir = hostpath.join(temp_dir, "dex", str(i))
-    with zipfile.ZipFile(hostpath.join(execroot, dexzip_name)) as dexzip:
-      for dex in zip_dexes:
-        zippath = new_manifest[dex].zippath
-        dexzip.extract(zippath, dexzip_tempdir)
-        files_to_push.append((hostpath.join(dexzip_tempdir, zippath),
-                              targetpath.join(dex_dir, dex)))
-
-  # Now gather all the dexes that are not within a .zip file.
-  dexes_to_upload = set(
-      d for d in dexes_to_upload if new_manifest[d].zippath == "-")
+  plain_dexes = []
+  zip_dexes = collections.defaultdict(list)
   for dex in dexes_to_upload:
-    files_to_push.append((new_manifest[dex].input_file, targetpath.join(
-        dex_dir, dex)))
+    entry = new_manifest[dex]
+    if entry.zippath == "-":
+      plain_dexes.append((entry.input_file, dex_prefix + dex))
+    else:
+      zip_dexes[entry.input_file].append((entry.zippath, dex))
+
+  # Start with the dexes that are not within a .zip file.
+  fs = adb.PushBatch(plain_dexes)
+
+  # Without a cache, dexes are unpacked under their name on the device so that
+  # PushBatch does not have to stage them again. With one, they are kept in the
+  # cache as long as the zip they were unpacked from does not change so that
+  # they are not unpacked again if they need to be pushed again.
+  dex_stagingdir = hostpath.join(cache_dir or temp_dir, "dex")
+  if not hostpath.isdir(dex_stagingdir):
+    os.makedirs(dex_stagingdir)
+  staging_prefix = hostpath.join(dex_stagingdir, "")
+  if cache_dir:
+    extract_cache_file = hostpath.join(cache_dir, "dex_extract_cache.json")
+    extracted = _PruneDexExtractCache(
+        _ReadJsonFile(extract_cache_file), dex_stagingdir)
+
+  to_unpack = collections.defaultdict(list)
+  remote_names = {}
+  unpacked_keys = {}
+  cached_dexes = []
+  for dexzip_name, dexes in six.iteritems(zip_dexes):
+    dexzip_path = hostpath.join(execroot, dexzip_name)
+    if not cache_dir:
+      to_unpack[dexzip_path] = dexes
+      remote_names.update((dex, dex) for _, dex in dexes)
+      continue
+
+    zip_key = [hostpath.abspath(dexzip_path)] + _FileStamp(dexzip_path)
+    for zippath, dex in dexes:
+      key = zip_key + [zippath]
+      name = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+      if extracted.get(name) == key:
+        cached_dexes.append((staging_prefix + name, dex_prefix + dex))
+      else:
+        to_unpack[dexzip_path].append((zippath, name))
+        remote_names[name] = dex
+        unpacked_keys[name] = key
 
-  num_files = len(dexes_to_delete) + len(files_to_push)
-  logging.info("Updating %d dex%s...", num_files, "es" if num_files > 1 else "")
+  if cached_dexes:
+    logging.info("Reusing %d unpacked dex%s...", len(cached_dexes),
+                 "es" if len(cached_dexes) > 1 else "")
+    fs.extend(adb.PushBatch(cached_dexes))
 
-  # Delete the dexes that are not in the new manifest
-  adb.DeleteMultiple(targetpath.join(dex_dir, dex) for dex in dexes_to_delete)
+  # Unpack the zips in parallel and push the dexes of each zip as soon as they
+  # are unpacked.
+  try:
+    with futures.ThreadPoolExecutor(max_workers=max(1, min(
+        len(to_unpack), multiprocessing.cpu_count()))) as unpacker:
+      unpacked = [
+          unpacker.submit(UnpackDexes, dexzip_path, dexes, dex_stagingdir)
+          for dexzip_path, dexes in six.iteritems(to_unpack)]
+      for f in futures.as_completed(unpacked):
+        names = f.result()
+        fs.extend(adb.PushBatch([
+            (staging_prefix + name, dex_prefix + remote_names[name])
+            for name in names]))
+        if cache_dir:
+          extracted.update((name, unpacked_keys[name]) for name in names)
+  except:  # pylint: disable=bare-except
+    CancelUploads(adb, fs)
+    raise
+
+  if cache_dir and unpacked_keys:
+    _WriteJsonFile(extract_cache_file, extracted)
+
+  # Upload the manifest if no dex upload failed.
+  fs.append(adb.PushStringAfter(
+      fs, dexmanifest, targetpath.join(dex_dir, "manifest")))
+  return fs
+
+
+def UnpackDexes(dexzip_name, dexes, output_dir):
+  """Unpacks dexes from a zip file.
 
-  # Upload all the files.
-  upload_walltime_start = time.time()
-  fs = [adb.Push(local, remote) for local, remote in files_to_push]
+  Args:
+    dexzip_name: the zip file to unpack from
+    dexes: a list of (zip path, file name) tuples of the dexes to unpack
+    output_dir: the directory to unpack to
+
+  Returns:
+    The file names of the unpacked dexes.
+  """
+  with zipfile.ZipFile(dexzip_name) as dexzip:
+    for zippath, dex in dexes:
+      with dexzip.open(zippath) as src:
+        with open(hostpath.join(output_dir, dex), "wb") as dst:
+          shutil.copyfileobj(src, dst, 1 << 20)
+  return [dex for _, dex in dexes]
+
+
+def CancelUploads(adb, fs):
+  """Cancels the given uploads and kills the ones already running."""
+  for f in fs:
+    f.cancel()
+  adb.AbortAll()
+  futures.wait(fs)
+
+
+def WaitForUploads(adb, fs):
+  """Waits for the given uploads, re-raising the first failure if any."""
   done, not_done = futures.wait(fs, return_when=futures.FIRST_EXCEPTION)
-  upload_walltime = time.time() - upload_walltime_start
-  logging.debug("Dex upload walltime: %s seconds", upload_walltime)
 
   # If there is anything in not_done, then some adb call failed and we
-  # can cancel the rest.
+  # can stop the rest.
   if not_done:
-    for f in not_done:
-      f.cancel()
+    CancelUploads(adb, not_done)
 
   # If any adb call resulted in an exception, re-raise it.
   for f in done:
     f.result()
 
-  # If no dex upload failed, upload the manifest. If any upload failed, the
-  # exception should have been re-raised above.
-  # Call result() to raise the exception if there was one.
-  adb.PushString(dexmanifest, targetpath.join(dex_dir, "manifest")).result()
-
 
 def Checksum(filename):
   """Compute the SHA-256 checksum of a file."""
   h = hashlib.sha256()
   with open(filename, "rb") as f:
-    while True:
-      data = f.read(65536)
-      if not data:
-        break
+    try:
+      # Hash the whole file with a single update() call over a memory mapping.
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+      # Empty files and special files cannot be mapped.
+      data = None
+
+    if data is not None:
+      try:
+        h.update(data)
+      finally:
+        data.close()
+    else:
+      while True:
+        data = f.read(1 << 20)
+        if not data:
+          break
 
-      h.update(data)
+        h.update(data)
 
   return h.hexdigest()
 
 
-def UploadResources(adb, resource_apk, app_dir):
+def ChecksumZip(filename):
+  """Compute a SHA-256 checksum of a zip file from its central directory.
+
+  Only the name, CRC-32, size and compression method of each entry are hashed,
+  so the entries themselves are never read or decompressed. Files that are not
+  zip files are hashed as a whole.
+  """
+  try:
+    with zipfile.ZipFile(filename) as z:
+      infos = sorted(z.infolist(), key=lambda i: i.filename)
+  except zipfile.BadZipfile:
+    return Checksum(filename)
+
+  h = hashlib.sha256()
+  for i in infos:
+    h.update(("%s:%08x:%d:%d\n" % (
+        i.filename, i.CRC, i.file_size, i.compress_type)).encode("utf-8"))
+  return h.hexdigest()
+
+
+def _FileStamp(filename):
+  """Returns the modification time in nanoseconds and the size of a file."""
+  st = os.stat(filename)
+  mtime_ns = getattr(st, "st_mtime_ns", None)
+  if mtime_ns is None:
+    mtime_ns = int(st.st_mtime * 1e9)
+  return [mtime_ns, st.st_size]
+
+
+def _PruneDexExtractCache(cache, staging_dir):
+  """Drops the dexes unpacked by an earlier run that cannot be reused.
+
+  Args:
+    cache: the contents of the dex extraction cache, a dict from the name of an
+      unpacked dex in staging_dir to the [zip, zip mtime in ns, zip size,
+      zip path] it was unpacked from.
+    staging_dir: the directory the dexes were unpacked to.
+
+  Returns:
+    The entries of the cache whose zip did not change since and whose dex is
+    still there. The dexes of all other entries are deleted.
+  """
+  if not isinstance(cache, dict):
+    cache = {}
+
+  stamps = {}
+  valid = {}
+  for name in os.listdir(staging_dir):
+    key = cache.get(name)
+    if (isinstance(key, list) and len(key) == 4 and
+        isinstance(key[0], six.string_types)):
+      if key[0] not in stamps:
+        try:
+          stamps[key[0]] = _FileStamp(key[0])
+        except EnvironmentError:
+          stamps[key[0]] = None
+      if stamps[key[0]] == key[1:3]:
+        valid[name] = key
+        continue
+
+    try:
+      os.remove(hostpath.join(staging_dir, name))
+    except EnvironmentError:
+      pass
+
+  return valid
+
+
+def GetCacheDir(user_home_dir):
+  """Returns the local cache directory or None if there is none."""
+  if not user_home_dir or not hostpath.isdir(user_home_dir):
+    return None
+  return hostpath.join(user_home_dir, CACHE_DIRECTORY)
+
+
+def _ReadJsonFile(path):
+  """Returns the contents of a JSON file or None if it cannot be read."""
+  try:
+    with open(path, "r") as f:
+      return json.load(f)
+  except (EnvironmentError, ValueError):
+    return None
+
+
+def _WriteJsonFile(path, contents):
+  """Atomically replaces a JSON file. Failures are logged and ignored."""
+  tmp = None
+  try:
+    directory = hostpath.dirname(path)
+    if not hostpath.isdir(directory):
+      os.makedirs(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "w") as f:
+      json.dump(contents, f)
+    getattr(os, "replace", os.rename)(tmp, path)
+  except EnvironmentError as e:
+    logging.debug("Cannot write %s: %s", path, e)
+    if tmp:
+      try:
+        os.remove(tmp)
+      except EnvironmentError:
+        pass
+
+
+def CachedChecksum(filename, cache_dir):
+  """Compute the ChecksumZip() of a file, reusing a cached one if possible.
+
+  The checksum is cached in cache_dir and reused as long as the modification
+  time and the size of the file stay the same.
+
+  Args:
+    filename: The file to checksum.
+    cache_dir: The local cache directory. May be None to disable caching.
+
+  Returns:
+    The hex digest of the checksum of the file.
+  """
+  if not cache_dir:
+    return ChecksumZip(filename)
+
+  cache_file = hostpath.join(cache_dir, "checksums.json")
+  cache = _ReadJsonFile(cache_file)
+  if not isinstance(cache, dict):
+    cache = {}
+
+  key = hostpath.abspath(filename)
+  stamp = _FileStamp(filename)
+  entry = cache.get(key)
+  if isinstance(entry, list) and len(entry) == 3 and entry[:2] == stamp:
+    return entry[2]
+
+  checksum = ChecksumZip(filename)
+  if len(cache) >= MAX_CACHED_CHECKSUMS:
+    # Forget about files that are gone, or everything if that is not enough.
+    cache = dict((k, v) for k, v in cache.items() if hostpath.exists(k))
+    if len(cache) >= MAX_CACHED_CHECKSUMS:
+      cache = {}
+  cache[key] = stamp + [checksum]
+  _WriteJsonFile(cache_file, cache)
+  return checksum
+
+
+def UploadResources(adb, resource_apk, app_dir, cache_dir=None):
   """Uploads resources to the device.
 
   Args:
     adb: The Adb instance representing the device to install to.
     resource_apk: Path to the resource apk.
     app_dir: The directory things should be installed under on the device.
+    cache_dir: The local cache directory. May be None to disable caching.
 
   Returns:
-    None.
+    A list of futures for the pending uploads. The checksum is written after
+    the resources were uploaded successfully.
   """
 
   # Compute the checksum of the new resources file
-  new_checksum = Checksum(resource_apk)
+  new_checksum = CachedChecksum(resource_apk, cache_dir)
 
   # Fetch the checksum of the resources file on the device, if it exists
   device_checksum_file = targetpath.join(app_dir, "resources_checksum")
   old_checksum = adb.Pull(device_checksum_file)
   if old_checksum == new_checksum:
     logging.info("Application resources up-to-date")
-    return
+    return []
   logging.info("Updating application resources...")
 
   # Remove the checksum file on the device so that if the transfer is
   # interrupted, we know how to get the device back to a consistent state.
   adb.Delete(device_checksum_file)
-  adb.Push(resource_apk, targetpath.join(app_dir, "resources.ap_")).result()
+  fs = [adb.Push(resource_apk, targetpath.join(app_dir, "resources.ap_"))]
 
-  # Write the new checksum to the device.
-  adb.PushString(new_checksum, device_checksum_file).result()
+  # Write the new checksum to the device once the resources are there.
+  fs.append(adb.PushStringAfter(fs, new_checksum, device_checksum_file))
+  return fs
 
 
 def ConvertNativeLibs(args):
@@ -568,13 +1106,15 @@ def UploadNativeLibs(adb, native_lib_args, app_dir, full_install):
   if device_manifest is None:
     # If we couldn't fetch the device manifest or if this is a non-incremental
     # install, wipe the slate clean
-    adb.Delete(targetpath.join(app_dir, "native"))
-
+    #
     # From Android 28 onwards, `adb push` creates directories with insufficient
     # permissions, resulting in errors when pushing files. `adb shell mkdir`
     # works correctly however, so we create the directory here.
     # See https://github.com/bazelbuild/examples/issues/77 for more information.
-    adb.Mkdir(targetpath.join(app_dir, "native"))
+    adb.BatchShell([
+        _DeleteCommand([targetpath.join(app_dir, "native")]),
+        _MkdirCommand(targetpath.join(app_dir, "native")),
+    ])
   else:
     # Otherwise, parse the manifest. Note that this branch is also taken if the
     # manifest is empty.
@@ -600,28 +1140,17 @@ def UploadNativeLibs(adb, native_lib_args, app_dir, full_install):
   logging.info("Updating %d native lib%s...",
                num_files, "s" if num_files != 1 else "")
 
-  adb.Delete(targetpath.join(app_dir, "native", "native_manifest"))
-
-  if libs_to_delete:
-    adb.DeleteMultiple(
-        [targetpath.join(app_dir, "native", lib) for lib in libs_to_delete])
+  # Delete the manifest first so that we know how to get back to a consistent
+  # state if we are interrupted.
+  adb.DeleteMultiple(
+      [targetpath.join(app_dir, "native", "native_manifest")] +
+      [targetpath.join(app_dir, "native", lib) for lib in libs_to_delete])
 
   upload_walltime_start = time.time()
-  fs = [adb.Push(local, remote) for local, remote in libs_to_push]
-  done, not_done = futures.wait(fs, return_when=futures.FIRST_EXCEPTION)
+  WaitForUploads(adb, adb.PushBatch(libs_to_push))
   upload_walltime = time.time() - upload_walltime_start
   logging.debug("Native library upload walltime: %s seconds", upload_walltime)
 
-  # If there is anything in not_done, then some adb call failed and we
-  # can cancel the rest.
-  if not_done:
-    for f in not_done:
-      f.cancel()
-
-  # If any adb call resulted in an exception, re-raise it.
-  for f in done:
-    f.result()
-
   install_manifest = [
       six.ensure_str(name) + " " + checksum
       for name, checksum in install_checksums.items()
@@ -754,6 +1283,7 @@ def IncrementalInstall(adb_path,
     extra_adb_args: Extra arguments that will always be passed to adb.
   """
   temp_dir = tempfile.mkdtemp()
+  adb = None
   try:
     adb = Adb(adb_path, temp_dir, adb_jobs, user_home_dir, extra_adb_args)
     app_package = GetAppPackage(hostpath.join(execroot, stub_datafile))
@@ -767,11 +1297,23 @@ def IncrementalInstall(adb_path,
 
       with open(hostpath.join(execroot, dexmanifest), "rb") as f:
         dexmanifest = six.ensure_str(f.read(), "utf-8")
-      UploadDexes(adb, execroot, app_dir, temp_dir, dexmanifest, bool(apk))
-      # TODO(ahumesky): UploadDexes waits for all the dexes to be uploaded, and
-      # then UploadResources is called. We could instead enqueue everything
-      # onto the threadpool so that uploading resources happens sooner.
-      UploadResources(adb, hostpath.join(execroot, resource_apk), app_dir)
+      # Upload the resources while the dexes are being uploaded.
+      upload_walltime_start = time.time()
+      cache_dir = GetCacheDir(user_home_dir)
+      dex_fs = UploadDexes(adb, execroot, app_dir, temp_dir, dexmanifest,
+                           bool(apk), cache_dir)
+      try:
+        resource_fs = UploadResources(
+            adb, hostpath.join(execroot, resource_apk), app_dir, cache_dir)
+      except:  # pylint: disable=bare-except
+        # Do not leave dex uploads running behind our back, they read files
+        # from temp_dir, which is about to be deleted.
+        CancelUploads(adb, dex_fs)
+        raise
+      WaitForUploads(adb, dex_fs + resource_fs)
+      upload_walltime = time.time() - upload_walltime_start
+      logging.debug("Dex and resource upload walltime: %s seconds",
+                    upload_walltime)
       UploadNativeLibs(adb, native_libs, app_dir, bool(apk))
       if apk:
         apk_path = targetpath.join(execroot, apk)
@@ -809,6 +1351,8 @@ def IncrementalInstall(adb_path,
   except AdbError as e:
     sys.exit("Error:\n%s" % str(e))
   finally:
+    if adb:
+      adb.Close()
     shutil.rmtree(temp_dir, True)
 
 
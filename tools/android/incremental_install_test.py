@@ -20,7 +20,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import fnmatch
+import json
 import os
+import threading
 import unittest
 import zipfile
 
@@ -46,12 +49,18 @@ class MockAdb(object):
     self.package_timestamp = None
     self._last_package_timestamp = 1
     self.shell_cmdlns = []
+    self.shell_sessions = 0
+    self.push_cmdlns = []
+    # Files written on the device, in order.
+    self.written = []
     self.abi = "armeabi-v7a"
 
   def Exec(self, args):
     if self._error:
       error_info, arg = self._error  # pylint: disable=unpacking-non-sequence
       if not arg or arg in args:
+        if args[1:] == ["shell"]:
+          return MockShell(self, error_info)
         return self._CreatePopenMock(*error_info)
 
     returncode = 0
@@ -59,10 +68,27 @@ class MockAdb(object):
     stderr = ""
     cmd = args[1]
     if cmd == "push":
-      # "/test/adb push local remote"
-      with open(args[2], "rb") as f:
-        content = f.read().decode("utf-8")
-      self.files[args[3]] = content
+      # "/test/adb push local... remote"
+      self.push_cmdlns.append(args[2:])
+      remote = args[-1]
+      for local in args[2:-1]:
+        with open(local, "rb") as f:
+          content = f.read().decode("utf-8")
+        if remote.endswith("/"):
+          self._Write(remote + os.path.basename(local), content)
+        else:
+          self._Write(remote, content)
+    elif cmd == "exec-in":
+      # "/test/adb exec-in 'cat > remote'", contents on stdin
+      if not args[2].startswith("cat > "):
+        raise Exception("Unknown exec-in command line: %s" % args[2])
+      remote = args[2][len("cat > "):]
+
+      def _Communicate(data=None):
+        self._Write(remote, six.ensure_str(data or b"", "utf-8"))
+        return "", ""
+
+      return mock.Mock(returncode=0, communicate=_Communicate)
     elif cmd == "pull":
       # "/test/adb pull remote local"
       remote = args[2]
@@ -92,31 +118,55 @@ class MockAdb(object):
       self.split_apks = set()
       self.package_timestamp = None
     elif cmd == "shell":
+      if len(args) == 2:
+        # "/test/adb shell"
+        self.shell_sessions += 1
+        return MockShell(self)
       # "/test/adb shell ..."
-      # mkdir, rm, am (application manager), or monkey
-      shell_cmdln = args[2]
-      self.shell_cmdlns.append(shell_cmdln)
-      if shell_cmdln.startswith(("mkdir", "am", "monkey", "input")):
-        pass
-      elif six.ensure_str(shell_cmdln).startswith("dumpsys package "):
-        if self.package_timestamp is not None:
-          timestamp = "firstInstallTime=%s" % self.package_timestamp
-        else:
-          timestamp = ""
-        return self._CreatePopenMock(0, timestamp, "")
-      elif six.ensure_str(shell_cmdln).startswith("rm"):
-        file_path = shell_cmdln.split()[2]
-        self.files.pop(file_path, None)
-      elif six.ensure_str(shell_cmdln).startswith("getprop ro.product.cpu.abi"):
-        return self._CreatePopenMock(0, self.abi, "")
-      else:
-        raise Exception("Unknown shell command line: %s" % shell_cmdln)
+      returncode, stdout = self.Shell(args[2])
     # Return a mock subprocess.Popen object
     return self._CreatePopenMock(returncode, stdout, stderr)
 
+  def _Write(self, remote, content):
+    self.files[remote] = content
+    self.written.append(remote)
+
+  def Shell(self, shell_cmdln):
+    """Runs a shell command line, returns its return code and output."""
+    self.shell_cmdlns.append(shell_cmdln)
+    output = []
+    for cmd in shell_cmdln.split(" && "):
+      returncode, stdout = self._ShellCommand(cmd)
+      output.append(stdout)
+      if returncode:
+        break
+    return returncode, "\n".join(o for o in output if o)
+
+  def _ShellCommand(self, shell_cmdln):
+    """Runs a single shell command, returns its return code and output."""
+    # mkdir, rm, am (application manager), or monkey
+    if shell_cmdln.startswith(("mkdir", "am", "monkey", "input")):
+      return 0, ""
+    elif six.ensure_str(shell_cmdln).startswith("dumpsys package "):
+      if self.package_timestamp is not None:
+        return 0, "firstInstallTime=%s" % self.package_timestamp
+      return 0, ""
+    elif six.ensure_str(shell_cmdln).startswith("rm"):
+      # "rm -fr path..." with files, directories and globs
+      for pattern in shell_cmdln.split()[2:]:
+        for f in list(self.files):
+          if (fnmatch.fnmatchcase(f, pattern) or
+              fnmatch.fnmatchcase(f, pattern + "/*")):
+            del self.files[f]
+      return 0, ""
+    elif six.ensure_str(shell_cmdln).startswith("getprop ro.product.cpu.abi"):
+      return 0, self.abi
+    else:
+      raise Exception("Unknown shell command line: %s" % shell_cmdln)
+
   def _CreatePopenMock(self, returncode, stdout, stderr):
     return mock.Mock(
-        returncode=returncode, communicate=lambda: (stdout, stderr))
+        returncode=returncode, communicate=lambda *_: (stdout, stderr))
 
   def SetError(self, returncode, stdout, stderr, for_arg=None):
     self._error = ((returncode, stdout, stderr), for_arg)
@@ -125,6 +175,50 @@ class MockAdb(object):
     self.abi = abi
 
 
+class MockShell(object):
+  """Mocks an interactive 'adb shell' session on the MockAdb device."""
+
+  def __init__(self, adb, error_info=None):
+    self._adb = adb
+    self._output = []
+    self._returncode = 0
+    self._error_returncode = None
+    self.returncode = None
+    if error_info:
+      # The session fails right away with the given output.
+      self._error_returncode, stdout, stderr = error_info
+      self._output = [l + "\n" for l in (stdout + stderr).splitlines()]
+    self.stdin = mock.Mock(write=self._Write)
+    self.stdout = mock.Mock(readline=self._ReadLine)
+
+  def _Write(self, data):
+    if self._error_returncode is not None:
+      return
+    for line in six.ensure_str(data).splitlines():
+      if line == "exit":
+        continue
+      if line.startswith("echo "):
+        output = line[len("echo "):].replace("$?", str(self._returncode))
+      else:
+        self._returncode, output = self._adb.Shell(line)
+      self._output.extend(l + "\n" for l in output.splitlines())
+
+  def _ReadLine(self):
+    if self._output:
+      return self._output.pop(0).encode("utf-8")
+    return b""
+
+  def wait(self):
+    self.returncode = self._error_returncode or 0
+    return self.returncode
+
+  def communicate(self, data=None):
+    if data:
+      self._Write(data)
+    self.wait()
+    return b"", None
+
+
 class IncrementalInstallTest(unittest.TestCase):
   """Unit tests for incremental install."""
 
@@ -191,7 +285,8 @@ class IncrementalInstallTest(unittest.TestCase):
 
   def _CallIncrementalInstall(self, incremental, native_libs=None,
                               split_main_apk=None, split_apks=None,
-                              start_type="no"):
+                              start_type="no", adb_jobs=1,
+                              user_home_dir="/home/root"):
     if split_main_apk:
       apk = split_main_apk
     elif incremental:
@@ -210,9 +305,9 @@ class IncrementalInstallTest(unittest.TestCase):
         split_apks=split_apks,
         native_libs=native_libs,
         output_marker=self._OUTPUT_MARKER,
-        adb_jobs=1,
+        adb_jobs=adb_jobs,
         start_type=start_type,
-        user_home_dir="/home/root")
+        user_home_dir=user_home_dir)
 
   def testUploadToPristineDevice(self):
     self._CreateZip()
@@ -235,6 +330,163 @@ class IncrementalInstallTest(unittest.TestCase):
     self.assertEqual("content3", self._GetDeviceFile("dex/ip3"))
     self.assertEqual("resource apk", self._GetDeviceFile("resources.ap_"))
 
+  def testUploadBatchesDexes(self):
+    self._CreateZip()
+
+    with open("dex1", "wb") as f:
+      f.write(b"content3")
+
+    with open("dex2", "wb") as f:
+      f.write(b"content4")
+
+    self._CreateLocalManifest(
+        "zip1 zp1 ip1 0",
+        "zip1 zp2 ip2 0",
+        "dex1 - ip3 0",
+        "dex2 - ip4 0")
+
+    self._CallIncrementalInstall(incremental=False)
+
+    # The dexes of each zip and the ones outside of zips are pushed together.
+    dex_dir = self._GetDeviceAppPath("dex") + "/"
+    dex_pushes = sorted(
+        sorted(os.path.basename(p) for p in push[:-1])
+        for push in self._mock_adb.push_cmdlns if push[-1] == dex_dir)
+    self.assertEqual([["ip1", "ip2"], ["ip3", "ip4"]], dex_pushes)
+    self.assertEqual("content3", self._GetDeviceFile("dex/ip3"))
+    self.assertEqual("content4", self._GetDeviceFile("dex/ip4"))
+
+  def _CheckSplitDexPushes(self):
+    dexes = [("zp%d" % i, "content%d" % i) for i in range(5)]
+    self._CreateZip("zip5", *dexes)
+    self._CreateLocalManifest(
+        *["zip5 zp%d ip%d 0" % (i, i) for i in range(5)])
+
+    with mock.patch.object(incremental_install, "MAX_FILES_PER_PUSH", 2):
+      self._CallIncrementalInstall(incremental=False, adb_jobs=2)
+
+    dex_dir = self._GetDeviceAppPath("dex") + "/"
+    dex_pushes = [p for p in self._mock_adb.push_cmdlns if p[-1] == dex_dir]
+    # Five files with at most two per push need three pushes, which is more
+    # than the two adb jobs.
+    self.assertEqual(3, len(dex_pushes))
+    for i in range(5):
+      self.assertEqual("content%d" % i, self._GetDeviceFile("dex/ip%d" % i))
+
+  def testUploadSplitsDexPushes(self):
+    self._CheckSplitDexPushes()
+
+  def testUploadCopiesDexesIfLinkingFails(self):
+    with mock.patch.object(incremental_install.os, "link",
+                           side_effect=OSError("no hard links")):
+      self._CheckSplitDexPushes()
+
+  def testUploadBalancesDexPushesBySize(self):
+    dexes = [("zp0", "x" * 1000), ("zp1", "a"), ("zp2", "b"), ("zp3", "c")]
+    self._CreateZip("zip4", *dexes)
+    self._CreateLocalManifest(
+        *["zip4 zp%d ip%d 0" % (i, i) for i in range(4)])
+
+    self._CallIncrementalInstall(incremental=False, adb_jobs=2)
+
+    dex_dir = self._GetDeviceAppPath("dex") + "/"
+    dex_pushes = sorted(
+        sorted(os.path.basename(p) for p in push[:-1])
+        for push in self._mock_adb.push_cmdlns if push[-1] == dex_dir)
+    self.assertEqual([["ip0"], ["ip1", "ip2", "ip3"]], dex_pushes)
+
+  def testUnpackedDexesAreReused(self):
+    home = os.path.join(os.environ["TEST_TMPDIR"], "home")
+    os.makedirs(home)
+    staging_dir = os.path.join(
+        incremental_install.GetCacheDir(home), "dex")
+    self._CreateZip("zip6")
+    self._CreateLocalManifest("zip6 zp1 ip1 0", "zip6 zp2 ip2 0")
+    self._CallIncrementalInstall(incremental=False, user_home_dir=home)
+    self.assertEqual(2, len(os.listdir(staging_dir)))
+
+    # Dexes from an unchanged zip are pushed without unpacking them again.
+    self._mock_adb.files.clear()
+    with mock.patch.object(incremental_install, "UnpackDexes") as unpack_mock:
+      self._CallIncrementalInstall(incremental=False, user_home_dir=home)
+      self.assertFalse(unpack_mock.called)
+    self.assertEqual("content1", self._GetDeviceFile("dex/ip1"))
+    self.assertEqual("content2", self._GetDeviceFile("dex/ip2"))
+
+    # Once the zip changes, they are unpacked again and the stale ones dropped.
+    st = os.stat("zip6")
+    self._CreateZip("zip6", ("zp1", "content3"), ("zp2", "content4"))
+    os.utime("zip6", (st.st_atime, st.st_mtime + 1))
+    self._CallIncrementalInstall(incremental=False, user_home_dir=home)
+    self.assertEqual("content3", self._GetDeviceFile("dex/ip1"))
+    self.assertEqual("content4", self._GetDeviceFile("dex/ip2"))
+    self.assertEqual(2, len(os.listdir(staging_dir)))
+
+  def testAbortAllKillsRunningAdbs(self):
+    adb = incremental_install.Adb(self._ADB_PATH, ".", 1, None, None)
+    started = threading.Event()
+    killed = threading.Event()
+
+    def Communicate(_):
+      started.set()
+      killed.wait(10)
+      return b"", b""
+
+    process = mock.Mock(returncode=-9)
+    process.communicate.side_effect = Communicate
+    process.kill.side_effect = killed.set
+    self._popen.side_effect = lambda args, **kwargs: process
+
+    f = adb.Push("local", "remote")
+    self.assertTrue(started.wait(10))
+    adb.AbortAll()
+    self.assertRaises(incremental_install.AdbError, f.result, 10)
+    self.assertTrue(process.kill.called)
+
+  def _WriteIndex(self, f):
+    remote = self._GetDeviceAppPath(f)
+    self.assertIn(remote, self._mock_adb.written)
+    return self._mock_adb.written.index(remote)
+
+  def testManifestAndChecksumWrittenAfterUploads(self):
+    self._CreateZip()
+    self._CreateLocalManifest(
+        "zip1 zp1 ip1 0",
+        "zip1 zp2 ip2 0")
+
+    self._CallIncrementalInstall(incremental=False)
+
+    self.assertGreater(self._WriteIndex("dex/manifest"),
+                       self._WriteIndex("dex/ip1"))
+    self.assertGreater(self._WriteIndex("dex/manifest"),
+                       self._WriteIndex("dex/ip2"))
+    self.assertGreater(self._WriteIndex("resources_checksum"),
+                       self._WriteIndex("resources.ap_"))
+
+  def testNoManifestWhenDexUploadFails(self):
+    self._CreateZip()
+    self._CreateLocalManifest(
+        "zip1 zp1 ip1 0",
+        "zip1 zp2 ip2 0")
+    self._mock_adb.SetError(1, "", "push failed",
+                            for_arg=self._GetDeviceAppPath("dex") + "/")
+
+    with self.assertRaises(SystemExit):
+      self._CallIncrementalInstall(incremental=False)
+    self.assertNotIn(self._GetDeviceAppPath("dex/manifest"),
+                     self._mock_adb.files)
+
+  def testNoChecksumWhenResourceUploadFails(self):
+    self._CreateZip()
+    self._CreateLocalManifest("zip1 zp1 ip1 0")
+    self._mock_adb.SetError(1, "", "push failed",
+                            for_arg=self._GetDeviceAppPath("resources.ap_"))
+
+    with self.assertRaises(SystemExit):
+      self._CallIncrementalInstall(incremental=False)
+    self.assertNotIn(self._GetDeviceAppPath("resources_checksum"),
+                     self._mock_adb.files)
+
   def testSplitInstallToPristineDevice(self):
     with open("split1", "wb") as f:
       f.write(b"split_content1")
@@ -444,6 +696,27 @@ class IncrementalInstallTest(unittest.TestCase):
     self._CallIncrementalInstall(incremental=True)
     self.assertFalse(self._GetDeviceAppPath("dex/ip2") in self._mock_adb.files)
 
+  def testDexDirectoryPreparedWithOneShellCommand(self):
+    self._CreateRemoteManifest(
+        "zip1 zp1 ip1 0",
+        "zip1 zip2 ip2 1")
+    self._PutDeviceFile("dex/ip1", "content1")
+    self._PutDeviceFile("dex/ip2", "content2")
+    self._PutDeviceFile("install_timestamp", "1")
+    self._mock_adb.package_timestamp = "1"
+
+    self._CreateZip("zip1", ("zp1", "content1"))
+    self._CreateLocalManifest("zip1 zp1 ip1 1")
+
+    self._CallIncrementalInstall(incremental=True)
+    dex_dir = self._GetDeviceAppPath("dex")
+    self.assertIn(
+        "mkdir -p %s && rm -fr %s/manifest %s/ip2" % (dex_dir, dex_dir, dex_dir),
+        self._mock_adb.shell_cmdlns)
+    self.assertEqual(["content1"], [
+        c for f, c in self._mock_adb.files.items() if f.startswith(dex_dir + "/ip")
+    ])
+
   def testNothingToUpdate(self):
     self._CreateRemoteManifest(
         "zip1 zp1 ip1 0",
@@ -484,6 +757,84 @@ class IncrementalInstallTest(unittest.TestCase):
     self._CallIncrementalInstall(incremental=True)
     self.assertEqual("resources", self._GetDeviceFile("resources.ap_"))
 
+  def testParseManifest(self):
+    manifest = incremental_install.ParseManifest(
+        "zip1 zp1 ip1 0\r\ndex1 - ip2 1\n\n")
+    self.assertEqual(
+        {
+            "ip1": incremental_install.ManifestEntry("zip1", "zp1", "ip1", "0"),
+            "ip2": incremental_install.ManifestEntry("dex1", "-", "ip2", "1"),
+        }, manifest)
+
+  def testCachedChecksum(self):
+    cache_dir = os.path.join(os.environ["TEST_TMPDIR"], "checksum_cache")
+    checksum = incremental_install.Checksum(self._RESOURCE_APK)
+    self.assertEqual(
+        checksum,
+        incremental_install.CachedChecksum(self._RESOURCE_APK, cache_dir))
+
+    # An unchanged file is not hashed again.
+    with mock.patch.object(incremental_install, "ChecksumZip") as checksum_mock:
+      self.assertEqual(
+          checksum,
+          incremental_install.CachedChecksum(self._RESOURCE_APK, cache_dir))
+      self.assertFalse(checksum_mock.called)
+
+    # A changed file is, even if its size stays the same.
+    st = os.stat(self._RESOURCE_APK)
+    with open(self._RESOURCE_APK, "wb") as f:
+      f.write(b"RESOURCE APK")
+    os.utime(self._RESOURCE_APK, (st.st_atime, st.st_mtime + 1))
+    self.assertEqual(
+        incremental_install.Checksum(self._RESOURCE_APK),
+        incremental_install.CachedChecksum(self._RESOURCE_APK, cache_dir))
+
+  def testChecksumZip(self):
+    def WriteZip(name, contents, compression):
+      with zipfile.ZipFile(name, "w", compression) as z:
+        for path, data in contents:
+          z.writestr(path, data)
+
+    WriteZip("stored.ap_", [("b", "b"), ("a", "a")], zipfile.ZIP_STORED)
+    WriteZip("reordered.ap_", [("a", "a"), ("b", "b")], zipfile.ZIP_STORED)
+    WriteZip("changed.ap_", [("a", "a"), ("b", "c")], zipfile.ZIP_STORED)
+    WriteZip("deflated.ap_", [("a", "a"), ("b", "b")], zipfile.ZIP_DEFLATED)
+    checksum = incremental_install.ChecksumZip("stored.ap_")
+
+    # Only the entries matter, not their order in the zip.
+    self.assertEqual(checksum, incremental_install.ChecksumZip("reordered.ap_"))
+    self.assertNotEqual(checksum, incremental_install.ChecksumZip("changed.ap_"))
+    self.assertNotEqual(
+        checksum, incremental_install.ChecksumZip("deflated.ap_"))
+
+    # Files that are not zips are hashed as a whole.
+    self.assertEqual(
+        incremental_install.Checksum(self._RESOURCE_APK),
+        incremental_install.ChecksumZip(self._RESOURCE_APK))
+
+  def testCachedChecksumIgnoresMalformedCache(self):
+    cache_dir = os.path.join(os.environ["TEST_TMPDIR"], "bad_checksum_cache")
+    os.makedirs(cache_dir)
+    key = os.path.abspath(self._RESOURCE_APK)
+    for entry in ("5", "[1, 2]", "\"garbage"):
+      with open(os.path.join(cache_dir, "checksums.json"), "w") as f:
+        f.write('{"%s": %s}' % (key, entry))
+      self.assertEqual(
+          incremental_install.Checksum(self._RESOURCE_APK),
+          incremental_install.CachedChecksum(self._RESOURCE_APK, cache_dir))
+
+  def testCachedChecksumIsBounded(self):
+    cache_dir = os.path.join(os.environ["TEST_TMPDIR"], "full_checksum_cache")
+    for i in range(incremental_install.MAX_CACHED_CHECKSUMS + 1):
+      name = "resource%d.ap_" % i
+      with open(name, "wb") as f:
+        f.write(b"resource apk %d" % i)
+      incremental_install.CachedChecksum(name, cache_dir)
+      os.remove(name)
+    with open(os.path.join(cache_dir, "checksums.json"), "r") as f:
+      self.assertLessEqual(
+          len(json.load(f)), incremental_install.MAX_CACHED_CHECKSUMS)
+
   def testUpdateResources(self):
     self._CreateRemoteManifest("zip1 zp1 ip1 0")
     self._PutDeviceFile("dex/ip1", "content1")
@@ -608,6 +959,40 @@ class IncrementalInstallTest(unittest.TestCase):
     self.assertTrue(background_cmd in self._mock_adb.shell_cmdlns)
     self.assertTrue(stop_cmd in self._mock_adb.shell_cmdlns)
 
+  def testShellCommandsShareOneSession(self):
+    self._CreateZip()
+    self._CreateLocalManifest("zip1 zp1 ip1 0")
+    with open("liba.so", "wb") as f:
+      f.write(b"liba")
+
+    self._CallIncrementalInstall(incremental=False,
+                                 native_libs=["armeabi-v7a:liba.so"],
+                                 start_type="cold")
+
+    self.assertIn("getprop ro.product.cpu.abi", self._mock_adb.shell_cmdlns)
+    self.assertIn("monkey -p %s -c android.intent.category.LAUNCHER 1" %
+                  self._APP_PACKAGE, self._mock_adb.shell_cmdlns)
+    self.assertEqual(1, self._mock_adb.shell_sessions)
+
+  def testGetInstallTimeOnlyFetchesTimestamp(self):
+    adb = incremental_install.Adb(self._ADB_PATH, ".", 1, None, None)
+    self._mock_adb.package_timestamp = "42"
+    self.assertEqual("42", adb.GetInstallTime(self._APP_PACKAGE))
+    self.assertEqual(
+        ["dumpsys package %s | grep firstInstallTime= || true" %
+         self._APP_PACKAGE], self._mock_adb.shell_cmdlns)
+
+  def testShellSessionErrors(self):
+    adb = incremental_install.Adb(self._ADB_PATH, ".", 1, None, None)
+    self._mock_adb.SetError(1, "", "error: device not found",
+                            for_arg="shell")
+    with self.assertRaises(incremental_install.DeviceNotFoundError):
+      adb.GetAbi()
+
+    self._mock_adb.SetError(1, "", "error: closed", for_arg="shell")
+    with self.assertRaises(incremental_install.AdbError):
+      adb.GetAbi()
+
   def testMultipleDevicesError(self):
     errors = [
         "more than one device and emulator",